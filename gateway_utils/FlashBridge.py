@@ -20,12 +20,13 @@
 NVParameters for attached bridge nodes"""
 
 
-import os
 import array
 import binascii
+import logging
 import RF200Flasher
+import pyintelhex
+import image_index
 import optparse
-import bz2
 import sys
 from cStringIO import StringIO
 
@@ -47,6 +48,54 @@ def build_magic_hrec(cmd, addr='02F0'):
     return text
 
 
+def load_image(filename, base_address=0):
+    """Load an image to flash, refusing any the library index marks invalid"""
+    entry = image_index.lookup(filename)
+    if entry is not None and not entry['valid']:
+        raise pyintelhex.ReaderError("marked invalid in the library index (%s)" %
+                                     entry.get('error'))
+    return pyintelhex.load_image(filename, base_address)
+
+
+def add_flash_options(parser):
+    """Add the options shared by every tool that flashes a bridge"""
+    parser.add_option("-b", "--base", dest="base", default="0",
+                      metavar="address", action="store",
+                      help="Base address of a raw .bin image (Default 0).")
+    parser.add_option("-r", "--resume", dest="resume", default=False,
+                      action="store_true",
+                      help="Resume an interrupted flash of the same image on this port; "
+                           "one acknowledged block is read back to confirm before skipping.")
+    parser.add_option("-d", "--delta", dest="delta", default=False,
+                      action="store_true",
+                      help="Only send blocks changed since the last verified flash "
+                           "on this port. Assumes the same bridge is still attached; "
+                           "one unchanged block is read back to confirm before skipping.")
+    parser.add_option("-l", "--log-level", dest="log_level", default="INFO",
+                      metavar="level", action="store",
+                      help="Logging level, e.g. DEBUG or WARNING (Default INFO).")
+    parser.add_option("--log-file", dest="log_file", default=None,
+                      metavar="path", action="store",
+                      help="Write the log to a file instead of stderr.")
+    parser.add_option("--trace", dest="trace", default=0, type="int",
+                      metavar="events", action="store",
+                      help="Keep this many recent protocol events and log them on failure.")
+
+
+def check_flash_options(options):
+    """Convert the shared flash options in place, exiting on bad values"""
+    try:
+        options.base = int(options.base, 0)
+    except ValueError:
+        print "Invalid base address"
+        sys.exit(1)
+
+    options.log_level = getattr(logging, options.log_level.upper(), None)
+    if not isinstance(options.log_level, int):
+        print "Invalid log level"
+        sys.exit(1)
+
+
 def parse_args():
     """Parse the arguments passed in on the command line
     to determine which function to perform"""
@@ -59,7 +108,8 @@ def parse_args():
                       help="Erase the current SnapPy script.")
     parser.add_option("-i", "--image", dest="image", default=None,
                       metavar="imageName", action="store",
-                      help="The image file to flash.")
+                      help="The image file to flash (.sfi, .hex, .bin or .blk).")
+    add_flash_options(parser)
     parser.add_option("-n", "--defaultnv", dest="defaultnv",
                       action="store_true", default=False,
                       help="Reset the device's NV params.")
@@ -78,12 +128,17 @@ def parse_args():
         options.port = int(options.port )
     except ValueError:
         pass
-    
+
+    check_flash_options(options)
     return options
 
 
 def main():
     ARGS = parse_args()
+    RF200Flasher.configure_logging(ARGS.log_level, ARGS.log_file)
+
+    IMAGE = None
+    FP = None
 
     if ARGS.erase:
         FP = StringIO(build_magic_hrec(MAGIC_KEY_CMD_ERASE_SCRIPT))
@@ -92,19 +147,15 @@ def main():
         FP = StringIO(build_magic_hrec(MAGIC_KEY_CMD_DEFAULT_NV))
         print "Default NV"
     else:
-        # Assume that the file is an SFI file
-        FP = bz2.BZ2File(ARGS.image, 'r')
         try:
-            # Try to go to the end of the file
-            FP.seek(-1, os.SEEK_END)
-            # And move back to the beginning
-            FP.seek(0, os.SEEK_SET)
-        except IOError:
-            # If we got an IOError, assume we were not an SFI file
-            # and open the file normally
-            FP = open(ARGS.image, 'rb')
-
-    RF200Flasher.flash(FP, ARGS.port)
+            IMAGE = load_image(ARGS.image, ARGS.base)
+        except pyintelhex.ReaderError, e:
+            print "Invalid image file: %s" % e
+            sys.exit(1)
+
+    if not RF200Flasher.flash(FP, ARGS.port, image=IMAGE, resume=ARGS.resume,
+                              delta=ARGS.delta, trace_size=ARGS.trace):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -22,30 +22,33 @@ __docformat__ = "plaintext en"
 
 import logging
 import datetime
+import collections
 import time
 import struct
 import os
 import platform
+import pprint
 
 from apy import EventScheduler
 
 log = logging.getLogger(__name__)
-if __debug__:
-    import pprint
 
 import pyintelhex
+import flash_journal
 from serialwrapper import PyserialDriver
 
 
 HELLO_INCOMING = '\xf9'
 HELLO_OUTGOING = '\xf6'
 BLOCK_COMMAND = 'b'
+READ_COMMAND = 'g'
 SIGNATURE_COMMAND = 's'
 INFO_COMMAND = 'I'
 ADDRESS_COMMAND = 'A'
 EXIT_COMMAND = 'E'
 
 ADDRESS_RESPONSE = '\r'
+UNKNOWN_RESPONSE = '?'
 EXIT_RESPONSE = '\r'
 
 ATMEGA128_SIGNATURE = '\x01\xa7\x1e'
@@ -68,6 +71,7 @@ class ATMegaFlasher(object):
     STATE_DATA_RESPONSE = 6
     STATE_EXIT_RESPONSE = 7
     STATE_TIMEOUT = 8
+    STATE_READ_RESPONSE = 9
 
     START_ADDRESS = 0
 
@@ -83,7 +87,13 @@ class ATMegaFlasher(object):
                  port=0,
                  pathToUsbLibrary='/usr/lib/python2.6/site-packages/serialwrapper',
                  prompt_func=None,
-                 info_func=None):
+                 info_func=None,
+                 image=None,
+                 journal=None,
+                 resume=False,
+                 manifest=None,
+                 delta=False,
+                 trace_size=0):
         if serialDrv is None:
             self.serialDrv = PyserialDriver.PyserialWrapper(dllPath=pathToUsbLibrary)
         else:
@@ -110,6 +120,23 @@ class ATMegaFlasher(object):
         self.prompt_func = prompt_func
         self.info_func = info_func
         self.finishedSuccessfully = False
+        self.journal = journal
+        self.resume = resume
+        self.manifest = manifest
+        self.delta = delta
+        self._manifest_blocks = {}
+        self._image_digests = {}
+        self._img_hash = None
+        self._full_blocks = []
+        self._trusted_blocks = []
+        self._probe = None
+        # Checked once so hot path debug logging costs a single attribute
+        # lookup when DEBUG is not enabled
+        self._debug = log.isEnabledFor(logging.DEBUG)
+        # Recent protocol events, only formatted if the flash fails
+        self._trace = None
+        if trace_size:
+            self._trace = collections.deque(maxlen=trace_size)
 
         self.state = self.STATE_INCOMING_WAIT
         self.state_handlers = {
@@ -120,13 +147,18 @@ class ATMegaFlasher(object):
             self.STATE_INFO_RESPONSE: self.handle_info,
             self.STATE_ADDRESS_RESPONSE: self.handle_address,
             self.STATE_DATA_RESPONSE: self.handle_data,
-            self.STATE_EXIT_RESPONSE: self.handle_exit
+            self.STATE_EXIT_RESPONSE: self.handle_exit,
+            self.STATE_READ_RESPONSE: self.handle_read
         }
         self._data_buff = ''
 
-        self.image = pyintelhex.IntelHexReader()
-        self.image.read(fp)
-        self.image.verify(round=1)
+        if image is None:
+            self.image = pyintelhex.IntelHexReader()
+            self.image.read(fp)
+            self.image.verify(round=1)
+        else:
+            # Pre-loaded binary or blocked images skip all hex parsing
+            self.image = image
         self._combined_data = None
         self._curr_combined_data = ''
         self._curr_combined_address = 0
@@ -139,6 +171,12 @@ class ATMegaFlasher(object):
         self.last_data = ''
 
     def _check_timeout(self):
+        if (self.state == self.STATE_READ_RESPONSE and
+           datetime.datetime.now()-self._lastData > self.timeout):
+            # Bootloaders without block reads may never answer
+            self._lastData = datetime.datetime.now()
+            self._probe_failed("Bootloader did not answer the block read")
+            return True
         if (self.state != self.STATE_IDLE and
            datetime.datetime.now()-self._lastData > self.timeout):
             self.state = self.STATE_TIMEOUT
@@ -150,12 +188,17 @@ class ATMegaFlasher(object):
 
     def close(self):
         self.serialDrv.close()
+        if self.journal is not None:
+            self.journal.close()
         self.state = self.STATE_IDLE
 
     def handle_address(self):
         if self._data_buff == ADDRESS_RESPONSE:
-            self.send_next_data()
             self._data_buff = ''
+            if self._probe is not None:
+                self.send_read_command()
+            else:
+                self.send_next_data()
         else:
             self._tellError("Unit was unable to change block address")
 
@@ -178,6 +221,8 @@ class ATMegaFlasher(object):
             received_checksum = struct.unpack(">H", self._data_buff)[0]
             data_checksum = sum(map(ord, self._curr_combined_data))
             if received_checksum == data_checksum:
+                if self.journal is not None:
+                    self.journal.record(self._curr_combined_address)
                 self._curr_combined_data = ''
                 self._retryCntr = 0
                 self.send_next_data()
@@ -185,22 +230,30 @@ class ATMegaFlasher(object):
                 log.error("Maximum number of retries reached")
                 self._tellError("Maximum number of retries reached")
             else:
-                log.debug("Retrying data, received checksum %i, should be %i" %
-                          (received_checksum, data_checksum))
+                log.debug("Retrying data, received checksum %i, should be %i",
+                          received_checksum, data_checksum)
                 self._retryCntr += 1
                 self.send_set_address(self._curr_combined_address)
             self._data_buff = ''
 
     def handle_exit(self):
         log.info("Flasher Finished!")
+        if self.journal is not None:
+            self.journal.clear()
+        if self.manifest is not None:
+            try:
+                self.manifest.verified(self.block_len, self.num_blocks,
+                                       self._manifest_blocks)
+            except (IOError, OSError):
+                log.warning("Unable to write flash manifest")
         if callable(self.finishedCallback):
             self.finishedCallback()
         self.finishedSuccessfully = True
         self.close()
 
     def handle_idle(self):
-        if __debug__:
-            log.debug("HANDLE IDLE: %i=%s" % (self.state, self._data_buff))
+        if self._debug:
+            log.debug("HANDLE IDLE: %i=%s", self.state, self._data_buff)
         self._data_buff = ''
 
     def handle_incoming(self):
@@ -222,22 +275,153 @@ class ATMegaFlasher(object):
 
         if ver in SUPPORTED_VERSIONS:
             self.num_blocks = num_blocks
-            self._combined_crc = self.image.combine(length=self.block_len,
-                                                    full_size=self.block_len*self.num_blocks,
-                                                    addr_adjust=1)
-            self._combined_data = self.image.get_combined_data_generator()
-            self.max_progress = len(self.image.combined_data)+3
-            ihrec = self._combined_data.next()
+            try:
+                self._combined_crc = self.image.combine(length=self.block_len,
+                                                        full_size=self.block_len*self.num_blocks,
+                                                        addr_adjust=1)
+            except pyintelhex.ReaderError, e:
+                self._tellError(str(e))
+                return
+            blocks = self._pending_blocks()
             # Update time just in case the combine took a while
             self._lastData = datetime.datetime.now()
 
-            self.send_set_address(ihrec.address)
-            self._curr_combined_data = ihrec.data
-            self._curr_combined_address = ihrec.int_address
+            if self._probe is not None:
+                # Read back a skipped block before trusting the journal
+                # or manifest
+                self.send_set_address(self._probe.address)
+            else:
+                self._start_sending(blocks)
         else:
             self._tellError("Device is running an unsupported version")
         self._data_buff = ''
 
+    def handle_read(self):
+        if self._data_buff == UNKNOWN_RESPONSE and self._probe.data[:1] != UNKNOWN_RESPONSE:
+            # A single '?' cannot be the start of the expected block, so the
+            # bootloader does not support block reads
+            self._probe_failed("Bootloader cannot read blocks back")
+            return
+        if len(self._data_buff) < self.block_len:
+            return
+
+        if self._data_buff[:self.block_len] == self._probe.data:
+            log.info("Read back @%04x matches, skipping unchanged blocks",
+                     self._probe.int_address)
+            self._probe = None
+            self._data_buff = ''
+            self._start_sending(self._trusted_blocks)
+        else:
+            self._probe_failed("Bridge does not hold the blocks being skipped")
+
+    def _probe_failed(self, reason):
+        """The attached bridge could not be verified; send every block"""
+        log.warning("%s, sending the full image", reason)
+        self._probe = None
+        self._data_buff = ''
+        # Nothing outside this image is known about the bridge any more
+        self._manifest_blocks = dict(self._image_digests)
+        if self.journal is not None:
+            # Acknowledgements carried over belong to some other bridge
+            try:
+                self.journal.start(self._img_hash, self.block_len,
+                                   self.num_blocks)
+            except (IOError, OSError):
+                log.warning("Unable to write flash journal, resume unavailable")
+                self.journal = None
+        self._start_sending(self._full_blocks)
+
+    def _start_sending(self, blocks):
+        self._combined_data = iter(blocks)
+        self.max_progress = len(blocks)+3
+
+        if not blocks:
+            log.info("No blocks left to send")
+            self.send_exit()
+            return
+        ihrec = self._combined_data.next()
+
+        self.send_set_address(ihrec.address)
+        self._curr_combined_data = ihrec.data
+        self._curr_combined_address = ihrec.int_address
+
+    def _pending_blocks(self):
+        """Return the combined blocks that still need to be sent, skipping
+        any acknowledged in a previous session when resuming and any that
+        are unchanged since the last verified flash in delta mode.
+
+        The journal and manifest are keyed by serial port, so skipping
+        assumes the same bridge is still attached. When blocks are skipped
+        the first of them is chosen as self._probe and read back before
+        anything is written; if it differs the full image is sent instead"""
+        self._full_blocks = self.image.combined_data
+        blocks = self._resume_blocks(self._full_blocks)
+        if self.manifest is not None:
+            blocks = self._delta_blocks(blocks)
+
+        pending = set(rec.int_address for rec in blocks)
+        skipped = [rec for rec in self._full_blocks
+                   if rec.int_address not in pending]
+        if skipped:
+            # Always probe the first skipped block so runs are reproducible
+            self._probe = skipped[0]
+            self._trusted_blocks = blocks
+        return blocks
+
+    def _delta_blocks(self, blocks):
+        known = self.manifest.load(self.block_len, self.num_blocks,
+                                   explain=self.delta)
+        digests = dict((rec.int_address, flash_journal.block_digest(rec.data))
+                       for rec in self._full_blocks)
+        if self.delta:
+            if known is None:
+                log.info("No trusted flash manifest, sending the full image")
+            else:
+                total = len(blocks)
+                blocks = [rec for rec in blocks
+                          if known.get(rec.int_address) != digests[rec.int_address]]
+                log.info("Delta flash, %i of %i blocks changed",
+                         len(blocks), total)
+
+        # What the bridge will hold once the exit command is acknowledged
+        self._manifest_blocks = dict(known or {})
+        self._manifest_blocks.update(digests)
+        self._image_digests = digests
+        try:
+            self.manifest.invalidate(self.block_len, self.num_blocks,
+                                     known or {})
+        except (IOError, OSError):
+            log.warning("Unable to write flash manifest, delta unavailable")
+            self.manifest = None
+        return blocks
+
+    def _resume_blocks(self, blocks):
+        if self.journal is None:
+            return blocks
+
+        img_hash = self._img_hash = flash_journal.image_hash(blocks)
+        acked = None
+        if self.resume:
+            acked = self.journal.acknowledged(img_hash, self.block_len,
+                                              self.num_blocks)
+            if acked is None:
+                log.info("No trusted flash journal, sending the full image")
+            else:
+                blocks = [rec for rec in blocks if rec.int_address not in acked]
+                log.info("Resuming flash, %i of %i blocks already acknowledged",
+                         len(self.image.combined_data)-len(blocks),
+                         len(self.image.combined_data))
+        elif self.journal.acknowledged(img_hash, self.block_len,
+                                       self.num_blocks):
+            log.info("An interrupted flash of this image can be resumed")
+        try:
+            self.journal.start(img_hash, self.block_len, self.num_blocks,
+                               acked or ())
+        except (IOError, OSError):
+            log.warning("Unable to write flash journal, resume unavailable")
+            self.journal = None
+        return blocks
+
     def handle_signature(self):
         if self._data_buff in SUPPORTED_SIGNATURES:
             self.send_info_command()
@@ -246,8 +430,10 @@ class ATMegaFlasher(object):
         self._data_buff = ''
 
     def onRead(self, data):
-        if __debug__:
-            log.debug("onRead: %s" % pprint.pformat(data))
+        if self._trace is not None:
+            self._trace.append((time.time(), 'rx', data))
+        if self._debug:
+            log.debug("onRead: %s", pprint.pformat(data))
         self._lastData = datetime.datetime.now()
         self._data_buff += data
         self.state_handlers.get(self.state, self.handle_idle)()
@@ -272,7 +458,10 @@ class ATMegaFlasher(object):
         self.state = self.STATE_BLOCK_CMD_RESPONSE
 
     def send_data(self, data):
-        log.debug("send_data @%s" % (self._curr_combined_address))
+        if self._trace is not None:
+            self._trace.append((time.time(), 'data', self._curr_combined_address))
+        if self._debug:
+            log.debug("send_data @%s", self._curr_combined_address)
         if isinstance(data, str):
             data = tuple(map(ord, data))
         assert isinstance(data, tuple)
@@ -310,11 +499,20 @@ class ATMegaFlasher(object):
 
         self.send_data(self._curr_combined_data)
 
+    def send_read_command(self):
+        log.debug("send_read_command")
+        self.serialDrv.write(struct.pack(">cHc", READ_COMMAND, self.block_len, "F"))
+        self.state = self.STATE_READ_RESPONSE
+
     def send_set_address(self, addr):
         if isinstance(addr, str):
             addr = int(addr, 16)
+        # Traced as a byte address, like the data events
+        if self._trace is not None:
+            self._trace.append((time.time(), 'address', addr))
         addr = addr/2
-        log.debug("send_set_address(%04x)" % (addr))
+        if self._debug:
+            log.debug("send_set_address(%04x)", addr)
         self.serialDrv.write(struct.pack(">cH", ADDRESS_COMMAND, addr))
         self.state = self.STATE_ADDRESS_RESPONSE
 
@@ -325,18 +523,48 @@ class ATMegaFlasher(object):
 
     def _tellError(self, msg, close=True):
         log.error(msg)
+        self._dump_trace()
         if close:
             self.close()
 
+    def _dump_trace(self):
+        if not self._trace:
+            return
+        log.error("Last %i protocol events:", len(self._trace))
+        for (stamp, event, value) in self._trace:
+            if event == 'rx':
+                value = repr(value)
+            else:
+                value = "%04x" % value
+            log.error("  %s.%03d %-7s %s",
+                      time.strftime('%H:%M:%S', time.localtime(stamp)),
+                      int(stamp * 1000) % 1000, event, value)
+        self._trace.clear()
+
 
-def flash(fp, comport):
+def configure_logging(level=logging.INFO, filename=None):
+    """Set up logging for the command line tools. Pass filename to log to a
+    file instead of stderr"""
     fmt = '%(asctime)s:%(msecs)03d %(levelname)-8s %(name)-8s %(message)s'
-    logging.basicConfig(level=logging.DEBUG,
+    logging.basicConfig(level=level,
                         format=fmt,
-                        datefmt='%H:%M:%S')
+                        datefmt='%H:%M:%S',
+                        filename=filename)
+
 
+def flash(fp, comport, image=None, resume=False, delta=False, trace_size=0):
     evScheduler = EventScheduler.EventScheduler()
-    flasher = ATMegaFlasher(fp, evScheduler, port=comport)
+    journal = flash_journal.FlashJournal(comport)
+    manifest = flash_journal.FlashManifest(comport)
+    if image is None:
+        # Raw hex streams (such as the magic erase records) change the
+        # bridge's flash in ways the manifest cannot describe
+        manifest.clear()
+        manifest = None
+    flasher = ATMegaFlasher(fp, evScheduler, port=comport, image=image,
+                            journal=journal, resume=resume,
+                            manifest=manifest, delta=delta,
+                            trace_size=trace_size)
     evScheduler.scheduleEvent(flasher.poll)
 
     if platform.machine() == 'armv5tejl':
@@ -344,6 +572,9 @@ def flash(fp, comport):
     else:
         print "Reset device to start"
 
-    while flasher.finishedSuccessfully is False:
+    # The flasher drops back to idle (or timeout) once it gives up
+    while (flasher.finishedSuccessfully is False and
+           flasher.state not in (flasher.STATE_IDLE, flasher.STATE_TIMEOUT)):
         evScheduler.poll()
         time.sleep(0.005)
+    return flasher.finishedSuccessfully
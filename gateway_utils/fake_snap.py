@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Copyright 2009-2014, Synapse Wireless Inc., All rights Reserved.
+#
+# Neither the name of Synapse nor the names of contributors may be used to
+# endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# This software is provided "AS IS," without a warranty of any kind. ALL
+# EXPRESS OR IMPLIED CONDITIONS, REPRESENTATIONS AND WARRANTIES, INCLUDING ANY
+# IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, ARE HEREBY EXCLUDED. SYNAPSE AND ITS LICENSORS SHALL NOT BE
+# LIABLE FOR ANY DAMAGES SUFFERED BY LICENSEE AS A RESULT OF USING, MODIFYING
+# OR DISTRIBUTING THIS SOFTWARE OR ITS DERIVATIVES. IN NO EVENT WILL SYNAPSE OR
+# ITS LICENSORS BE LIABLE FOR ANY LOST REVENUE, PROFIT OR DATA, OR FOR DIRECT,
+# INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE DAMAGES, HOWEVER
+# CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, ARISING OUT OF THE USE OF
+# OR INABILITY TO USE THIS SOFTWARE, EVEN IF SYNAPSE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+"""A local stand-in for the parts of SNAP Connect that SpyUploader uses, so
+the upload path can be exercised and benchmarked without a bridge attached.
+
+Mesh behaviour is simulated with a LinkModel: every SPY chunk takes
+chunk_latency seconds to be acknowledged and is lost with probability loss,
+in which case it is resent after retry_timeout. Like bytes arriving on the
+serial port, replies are only handled by FakeSnap.poll_internals() once
+they are due, so a slow poll loop delays the upload as it would for real"""
+
+
+import time
+import heapq
+import random
+
+from snaplib import SnappyUploader
+
+
+FAKE_UPLOAD_FAILED = -1
+DEFAULT_BRIDGE_ADDR = '\x00\x00\x01'
+
+
+class LinkModel(object):
+    def __init__(self, chunk_latency=0.02, loss=0.0, discovery_latency=0.1,
+                 reboot_latency=0.2, chunk_size=64, retry_timeout=0.25,
+                 max_retries=5, seed=None):
+        self.chunk_latency = chunk_latency
+        self.loss = loss
+        self.discovery_latency = discovery_latency
+        self.reboot_latency = reboot_latency
+        self.chunk_size = chunk_size
+        self.retry_timeout = retry_timeout
+        self.max_retries = max_retries
+        self.random = random.Random(seed)
+
+    def lost(self):
+        return self.random.random() < self.loss
+
+
+class FakeScheduler(object):
+    """Mimics the SNAP Connect scheduler: poll() runs every due event and
+    returns the seconds until the next one (None if nothing is scheduled).
+    Events that return True are rescheduled with the same delay"""
+    def __init__(self):
+        self._events = []
+        self._seq = 0
+
+    def schedule(self, delay, callback, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (time.time() + delay, self._seq, delay,
+                                      callback, args))
+
+    def poll(self):
+        now = time.time()
+        while self._events and self._events[0][0] <= now:
+            (_, _, delay, callback, args) = heapq.heappop(self._events)
+            if callback(*args) is True:
+                self.schedule(delay, callback, *args)
+        if not self._events:
+            return None
+        return max(0, self._events[0][0] - time.time())
+
+
+class FakeUpload(object):
+    def __init__(self, remote_addr, spy, chunk_size):
+        self.remote_addr = remote_addr
+        self.chunks = [spy[i:i+chunk_size] for i in range(0, len(spy), chunk_size)]
+        self.next_chunk = 0
+        self.retries = 0
+        self.chunks_sent = 0
+        self.chunks_lost = 0
+        self._finished_callbacks = []
+
+    def registerFinishedCallback(self, callback):
+        self._finished_callbacks.append(callback)
+
+    def finish(self, result):
+        for callback in self._finished_callbacks:
+            callback(self, result)
+
+
+class FakeUploadManager(object):
+    """Drives uploads chunk by chunk. Acknowledgements come back through the
+    'tellVmStat' and 'su_recvd_reboot' RPC functions registered with the
+    FakeSnap, just as they would from a real bridge"""
+    def __init__(self, comm):
+        self.comm = comm
+        self.uploads = {}
+
+    def startUpload(self, remote_addr, spy):
+        upload = FakeUpload(remote_addr, spy, self.comm.link.chunk_size)
+        self.uploads[remote_addr] = upload
+        self._send_chunk(upload)
+        return upload
+
+    def _send_chunk(self, upload):
+        if self.uploads.get(upload.remote_addr) is not upload:
+            return
+        link = self.comm.link
+        upload.chunks_sent += 1
+        if upload.remote_addr != self.comm.bridge_addr or link.lost():
+            upload.chunks_lost += 1
+            self.comm.scheduler.schedule(link.retry_timeout, self._retry, upload)
+        else:
+            self.comm.receive(link.chunk_latency, self.comm.rpc,
+                              upload.remote_addr, 'tellVmStat',
+                              upload.next_chunk)
+
+    def _retry(self, upload):
+        if self.uploads.get(upload.remote_addr) is not upload:
+            return
+        upload.retries += 1
+        if upload.retries > self.comm.link.max_retries:
+            del self.uploads[upload.remote_addr]
+            upload.finish(FAKE_UPLOAD_FAILED)
+        else:
+            self._send_chunk(upload)
+
+    def onTellVmStat(self, src_addr, chunk):
+        upload = self.uploads.get(src_addr)
+        if upload is None or chunk != upload.next_chunk:
+            return
+        upload.next_chunk += 1
+        upload.retries = 0
+        if upload.next_chunk < len(upload.chunks):
+            self._send_chunk(upload)
+        else:
+            self.comm.receive(self.comm.link.reboot_latency, self.comm.rpc,
+                              src_addr, 'su_recvd_reboot')
+
+    def on_recvd_reboot(self, src_addr):
+        upload = self.uploads.pop(src_addr, None)
+        if upload is not None:
+            upload.finish(SnappyUploader.SNAPPY_PROGRESS_COMPLETE)
+
+
+class FakeSnap(object):
+    """Stand-in for snapconnect.snap.Snap. Pass a factory such as
+    lambda funcs: FakeSnap(funcs, link) as SpyUploader's comm_factory"""
+    def __init__(self, funcs=None, link=None, bridge_addr=DEFAULT_BRIDGE_ADDR):
+        self.funcs = funcs or {}
+        self.link = link or LinkModel()
+        self.bridge_addr = bridge_addr
+        self.nv_params = {}
+        self.scheduler = FakeScheduler()
+        self.spy_upload_mgr = FakeUploadManager(self)
+        self._callbacks = {}
+        self._rpc_source_addr = None
+        self._incoming = []
+        self._seq = 0
+
+    def save_nv_param(self, nv_id, value):
+        self.nv_params[nv_id] = value
+
+    def register_callback(self, name, callback):
+        self._callbacks.setdefault(name, []).append(callback)
+
+    def open_serial(self, serial_type, port):
+        self.receive(self.link.discovery_latency, self._discovered)
+
+    def _discovered(self):
+        for callback in self._callbacks.get('next_hop_addr', []):
+            callback(self.bridge_addr, 0)
+
+    def rpc(self, src_addr, func, *args):
+        """Deliver an incoming RPC from src_addr"""
+        self._rpc_source_addr = src_addr
+        try:
+            self.funcs[func](*args)
+        finally:
+            self._rpc_source_addr = None
+
+    def rpc_source_addr(self):
+        return self._rpc_source_addr
+
+    def receive(self, delay, callback, *args):
+        """Queue something arriving from the bridge in delay seconds"""
+        self._seq += 1
+        heapq.heappush(self._incoming, (time.time() + delay, self._seq,
+                                        callback, args))
+
+    def poll_internals(self):
+        now = time.time()
+        while self._incoming and self._incoming[0][0] <= now:
+            (_, _, callback, args) = heapq.heappop(self._incoming)
+            callback(*args)
+
+    def poll(self):
+        self.poll_internals()
+        self.scheduler.poll()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# Copyright 2009-2014, Synapse Wireless Inc., All rights Reserved.
+#
+# Neither the name of Synapse nor the names of contributors may be used to
+# endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# This software is provided "AS IS," without a warranty of any kind. ALL
+# EXPRESS OR IMPLIED CONDITIONS, REPRESENTATIONS AND WARRANTIES, INCLUDING ANY
+# IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, ARE HEREBY EXCLUDED. SYNAPSE AND ITS LICENSORS SHALL NOT BE
+# LIABLE FOR ANY DAMAGES SUFFERED BY LICENSEE AS A RESULT OF USING, MODIFYING
+# OR DISTRIBUTING THIS SOFTWARE OR ITS DERIVATIVES. IN NO EVENT WILL SYNAPSE OR
+# ITS LICENSORS BE LIABLE FOR ANY LOST REVENUE, PROFIT OR DATA, OR FOR DIRECT,
+# INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE DAMAGES, HOWEVER
+# CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, ARISING OUT OF THE USE OF
+# OR INABILITY TO USE THIS SOFTWARE, EVEN IF SYNAPSE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+"""Persists per-port flash state between sessions: a journal of the blocks
+acknowledged by the bootloader so an interrupted session can be resumed,
+and a manifest of the last verified flash so later flashes can be deltas"""
+
+
+import os
+import re
+import json
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_JOURNAL_DIR = os.path.expanduser('~/.gateway_utils')
+
+
+def _port_path(journal_dir, prefix, port, ext):
+    return os.path.join(journal_dir, '%s-%s.%s' % (prefix,
+                                                   re.sub(r'[^\w.-]', '_', str(port)),
+                                                   ext))
+
+
+def block_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def image_hash(blocks):
+    """Hash the combined (address, data) blocks of an image"""
+    digest = hashlib.sha1()
+    for rec in blocks:
+        digest.update(rec.address)
+        digest.update(rec.data)
+    return digest.hexdigest()
+
+
+class FlashJournal(object):
+    """One journal file per serial port. The header records the image hash
+    and bootloader geometry; every following line is an acknowledged block
+    address. A journal is only trusted if the header matches exactly"""
+    def __init__(self, port, journal_dir=DEFAULT_JOURNAL_DIR):
+        self.path = _port_path(journal_dir, 'flash', port, 'journal')
+        self._fp = None
+
+    def _header(self, img_hash, block_len, num_blocks):
+        return "%s %d %d" % (img_hash, block_len, num_blocks)
+
+    def acknowledged(self, img_hash, block_len, num_blocks):
+        """Return the set of block addresses acknowledged by a previous
+        session of the same image and geometry, or None if untrusted"""
+        try:
+            fp = open(self.path, 'r')
+        except IOError:
+            return None
+        try:
+            lines = fp.read().split('\n')
+        finally:
+            fp.close()
+
+        if lines[0] != self._header(img_hash, block_len, num_blocks):
+            return None
+        acked = set()
+        # The final line may have been cut short when the session died
+        for line in lines[1:-1]:
+            try:
+                acked.add(int(line, 16))
+            except ValueError:
+                return None
+        return acked
+
+    def start(self, img_hash, block_len, num_blocks, acked=()):
+        """Open a fresh journal for writing, carrying over any blocks
+        already acknowledged when resuming"""
+        self.close()
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self._fp = open(self.path, 'w')
+        self._fp.write(self._header(img_hash, block_len, num_blocks) + '\n')
+        for address in sorted(acked):
+            self._fp.write("%X\n" % address)
+        self._fp.flush()
+
+    def record(self, address):
+        if self._fp is not None:
+            self._fp.write("%X\n" % address)
+            self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def clear(self):
+        """Remove the journal after a successful flash"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class FlashManifest(object):
+    """Per-block digests of what the last verified flash left on the bridge
+    attached to a serial port.
+
+    The manifest is marked unverified as soon as a flash starts writing and
+    is only verified again once the bootloader acknowledges the exit command,
+    so an interrupted or failed session always forces the next flash to send
+    the full image. It is also ignored if the bootloader geometry differs"""
+    def __init__(self, port, journal_dir=DEFAULT_JOURNAL_DIR):
+        self.path = _port_path(journal_dir, 'flash', port, 'manifest')
+
+    def load(self, block_len, num_blocks, explain=False):
+        """Return {address: digest} if the manifest can be trusted for this
+        geometry, otherwise None. Set explain to log why it is untrusted"""
+        try:
+            fp = open(self.path, 'r')
+            try:
+                manifest = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(manifest, dict):
+            return None
+        if not manifest.get('verified'):
+            if explain:
+                log.info("Last flash was not verified, delta unavailable")
+            return None
+        if (manifest.get('block_len') != block_len or
+           manifest.get('num_blocks') != num_blocks):
+            if explain:
+                log.info("Bootloader geometry changed, delta unavailable")
+            return None
+        try:
+            return dict((int(addr, 16), digest)
+                        for (addr, digest) in manifest['blocks'].items())
+        except (KeyError, AttributeError, ValueError):
+            return None
+
+    def _save(self, block_len, num_blocks, blocks, verified):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        fp = open(self.path, 'w')
+        try:
+            json.dump({'block_len': block_len,
+                       'num_blocks': num_blocks,
+                       'verified': verified,
+                       'blocks': dict(("%X" % addr, digest)
+                                      for (addr, digest) in blocks.items())},
+                      fp, sort_keys=True)
+        finally:
+            fp.close()
+
+    def invalidate(self, block_len, num_blocks, blocks):
+        """Mark the manifest unverified before any block is written"""
+        self._save(block_len, num_blocks, blocks, False)
+
+    def verified(self, block_len, num_blocks, blocks):
+        """Record the digests of a flash the bootloader fully acknowledged"""
+        self._save(block_len, num_blocks, blocks, True)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright 2009-2014, Synapse Wireless Inc., All rights Reserved.
+#
+# Neither the name of Synapse nor the names of contributors may be used to
+# endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# This software is provided "AS IS," without a warranty of any kind. ALL
+# EXPRESS OR IMPLIED CONDITIONS, REPRESENTATIONS AND WARRANTIES, INCLUDING ANY
+# IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, ARE HEREBY EXCLUDED. SYNAPSE AND ITS LICENSORS SHALL NOT BE
+# LIABLE FOR ANY DAMAGES SUFFERED BY LICENSEE AS A RESULT OF USING, MODIFYING
+# OR DISTRIBUTING THIS SOFTWARE OR ITS DERIVATIVES. IN NO EVENT WILL SYNAPSE OR
+# ITS LICENSORS BE LIABLE FOR ANY LOST REVENUE, PROFIT OR DATA, OR FOR DIRECT,
+# INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE DAMAGES, HOWEVER
+# CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, ARISING OUT OF THE USE OF
+# OR INABILITY TO USE THIS SOFTWARE, EVEN IF SYNAPSE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+"""Converts SFI/Intel HEX images into raw binary (.bin) or pre-blocked (.blk)
+images that flash_bridge can load without any text parsing. Binary images
+always start at address 0 so they flash correctly without a base address"""
+
+
+import os
+import sys
+import optparse
+
+import pyintelhex
+
+
+def convert(filename, output, block_len=None):
+    """Convert filename to output. If block_len is given a blocked image is
+    written instead of a flat one"""
+    reader = pyintelhex.load_image(filename)
+    if not isinstance(reader, pyintelhex.IntelHexReader):
+        raise pyintelhex.ReaderError("Input is not an SFI or Intel HEX file")
+
+    data = reader.to_binary()
+    image = pyintelhex.BinaryImage(data)
+
+    fp = open(output, 'wb')
+    try:
+        if block_len:
+            pyintelhex.BlockedImage.from_binary(image, block_len).write(fp)
+        else:
+            fp.write(data)
+    finally:
+        fp.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] input [output]")
+    parser.add_option("-b", "--blocked", dest="block_len", default=None,
+                      type="int", metavar="length",
+                      help="Write a pre-blocked .blk image using this block length.")
+    (options, args) = parser.parse_args()
+
+    if len(args) not in (1, 2):
+        parser.error("An input image is required")
+
+    if len(args) == 2:
+        output = args[1]
+    else:
+        ext = '.blk' if options.block_len else '.bin'
+        output = os.path.splitext(args[0])[0] + ext
+
+    try:
+        convert(args[0], output, options.block_len)
+    except (IOError, pyintelhex.ReaderError), e:
+        print "Unable to convert image: %s" % e
+        sys.exit(1)
+
+    print "Wrote %s" % output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright 2009-2014, Synapse Wireless Inc., All rights Reserved.
+#
+# Neither the name of Synapse nor the names of contributors may be used to
+# endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# This software is provided "AS IS," without a warranty of any kind. ALL
+# EXPRESS OR IMPLIED CONDITIONS, REPRESENTATIONS AND WARRANTIES, INCLUDING ANY
+# IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, ARE HEREBY EXCLUDED. SYNAPSE AND ITS LICENSORS SHALL NOT BE
+# LIABLE FOR ANY DAMAGES SUFFERED BY LICENSEE AS A RESULT OF USING, MODIFYING
+# OR DISTRIBUTING THIS SOFTWARE OR ITS DERIVATIVES. IN NO EVENT WILL SYNAPSE OR
+# ITS LICENSORS BE LIABLE FOR ANY LOST REVENUE, PROFIT OR DATA, OR FOR DIRECT,
+# INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE DAMAGES, HOWEVER
+# CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, ARISING OUT OF THE USE OF
+# OR INABILITY TO USE THIS SOFTWARE, EVEN IF SYNAPSE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+"""Indexes and validates a directory of SFI/HEX/binary bridge images.
+The resulting index lets flash_bridge reject corrupt images up front"""
+
+
+import os
+import sys
+import json
+import optparse
+import multiprocessing
+
+import pyintelhex
+
+
+INDEX_FILENAME = 'index.json'
+IMAGE_EXTENSIONS = ('.sfi', '.hex', '.bin', '.blk')
+
+# (block length, number of blocks) reported by supported bootloaders
+SUPPORTED_GEOMETRIES = ((256, 512),
+                        (512, 256),)
+
+
+def geometry_key(block_len, num_blocks):
+    return "%dx%d" % (block_len, num_blocks)
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+def index_image(args):
+    """Load, verify and combine a single image. Runs in a worker process"""
+    (path, geometries) = args
+    entry = _file_stamp(path)
+    entry['valid'] = False
+    entry['geometries'] = {}
+    try:
+        image = pyintelhex.load_image(path)
+        for (block_len, num_blocks) in geometries:
+            if (isinstance(image, pyintelhex.BlockedImage) and
+               block_len != image.block_len):
+                # Blocked images only apply to their own block length
+                continue
+            # combine() appends to combined_data, so start each geometry fresh
+            image.combined_data = []
+            crc = image.combine(length=block_len,
+                                full_size=block_len*num_blocks,
+                                addr_adjust=1)
+            blocks = [rec.int_address/block_len for rec in image.combined_data]
+            entry['geometries'][geometry_key(block_len, num_blocks)] = {
+                'crc': crc,
+                'blocks': blocks,
+            }
+    except Exception, e:
+        # Any failure is a property of this image; record it rather than
+        # letting it take down the whole pool
+        entry['error'] = str(e) or e.__class__.__name__
+    else:
+        entry['valid'] = True
+    return (os.path.basename(path), entry)
+
+
+def build_index(directory, geometries=SUPPORTED_GEOMETRIES, processes=None):
+    """Index every image in directory using a pool of worker processes"""
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+             if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(index_image, [(path, geometries) for path in paths])
+    finally:
+        pool.close()
+        pool.join()
+    return dict(results)
+
+
+def write_index(directory, index):
+    fp = open(os.path.join(directory, INDEX_FILENAME), 'w')
+    try:
+        json.dump(index, fp, sort_keys=True)
+    finally:
+        fp.close()
+
+
+def lookup(path):
+    """Return the index entry for path, or None if the image's directory has
+    no index or the entry is stale"""
+    index_path = os.path.join(os.path.dirname(os.path.abspath(path)), INDEX_FILENAME)
+    try:
+        fp = open(index_path, 'r')
+        try:
+            index = json.load(fp)
+        finally:
+            fp.close()
+    except (IOError, ValueError):
+        return None
+
+    entry = index.get(os.path.basename(path))
+    if entry is None:
+        return None
+    try:
+        stamp = _file_stamp(path)
+    except OSError:
+        return None
+    if stamp['size'] != entry.get('size') or stamp['mtime'] != entry.get('mtime'):
+        return None
+    return entry
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] directory")
+    parser.add_option("-j", "--jobs", dest="jobs", default=None, type="int",
+                      help="Number of worker processes (Default one per CPU).")
+    parser.add_option("-g", "--geometry", dest="geometries", default=[],
+                      action="append", metavar="LENxCOUNT",
+                      help="Additional block geometry to index, e.g. 256x512.")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error("An image directory is required")
+
+    geometries = list(SUPPORTED_GEOMETRIES)
+    for geometry in options.geometries:
+        try:
+            (block_len, num_blocks) = [int(x) for x in geometry.lower().split('x')]
+        except ValueError:
+            parser.error("Invalid geometry %s" % geometry)
+        geometries.append((block_len, num_blocks))
+
+    index = build_index(args[0], geometries, options.jobs)
+    write_index(args[0], index)
+
+    bad = sorted(name for (name, entry) in index.items() if not entry['valid'])
+    for name in bad:
+        print "%s: %s" % (name, index[name]['error'])
+    print "Indexed %d images, %d invalid" % (len(index), len(bad))
+    if bad:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
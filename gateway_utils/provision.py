@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Copyright 2009-2014, Synapse Wireless Inc., All rights Reserved.
+#
+# Neither the name of Synapse nor the names of contributors may be used to
+# endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# This software is provided "AS IS," without a warranty of any kind. ALL
+# EXPRESS OR IMPLIED CONDITIONS, REPRESENTATIONS AND WARRANTIES, INCLUDING ANY
+# IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, ARE HEREBY EXCLUDED. SYNAPSE AND ITS LICENSORS SHALL NOT BE
+# LIABLE FOR ANY DAMAGES SUFFERED BY LICENSEE AS A RESULT OF USING, MODIFYING
+# OR DISTRIBUTING THIS SOFTWARE OR ITS DERIVATIVES. IN NO EVENT WILL SYNAPSE OR
+# ITS LICENSORS BE LIABLE FOR ANY LOST REVENUE, PROFIT OR DATA, OR FOR DIRECT,
+# INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE DAMAGES, HOWEVER
+# CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, ARISING OUT OF THE USE OF
+# OR INABILITY TO USE THIS SOFTWARE, EVEN IF SYNAPSE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+"""Provisions an attached bridge node in one pass: flashes a SNAP core image
+and then uploads a SPY script over the same serial port. Both artifacts and
+the SNAP Connect instance are prepared before the flash starts so the upload
+can begin as soon as the bridge reboots"""
+
+
+import sys
+import time
+import optparse
+
+from snapconnect import snap
+
+import pyintelhex
+import FlashBridge
+import RF200Flasher
+import spy_uploader
+
+
+# A freshly flashed core has to reboot before it can announce itself, which
+# can take much longer than the BRIDGE_TIMEOUT tuned for a running bridge
+REBOOT_DISCOVERY_TIMEOUT = 15.0  # seconds
+
+
+def provision(image_path, spy_path, port, serial_type=snap.SERIAL_TYPE_RS232,
+              base_address=0, resume=False, delta=False, cache=None,
+              trace_size=0, discovery_timeout=REBOOT_DISCOVERY_TIMEOUT):
+    """Returns (exit code, [(stage, seconds), ...])"""
+    timings = []
+    mark = [time.time()]
+
+    def stage(name):
+        now = time.time()
+        timings.append((name, now - mark[0]))
+        mark[0] = now
+
+    try:
+        image = FlashBridge.load_image(image_path, base_address)
+    except (IOError, pyintelhex.ReaderError), e:
+        print "Invalid image file: %s" % e
+        return (1, timings)
+
+    uploader = spy_uploader.SpyUploader(spy_path, serial_type, port, cache,
+                                        defer_open=True,
+                                        discovery_timeout=discovery_timeout)
+    if not uploader.load_spy():
+        print "Unable to read SPY file"
+        return (1, timings)
+    stage('prepare')
+
+    if not RF200Flasher.flash(None, port, image=image, resume=resume,
+                              delta=delta, trace_size=trace_size):
+        print "Flashing the SNAP core failed"
+        stage('flash')
+        return (1, timings)
+    stage('flash')
+
+    # The flasher has released the port, hand it straight to SNAP Connect.
+    # The core is still rebooting, so a cached address would only send
+    # chunks into the void; the upload starts once the bridge announces
+    # itself, and the address it announces is cached for later runs
+    uploader.open(use_cache=False)
+    stage('switch')
+
+    uploader.run()
+    if uploader.discovered_at is not None:
+        # Split the bridge reboot/discovery wait from the upload itself
+        timings.append(('reboot', uploader.discovered_at - mark[0]))
+        mark[0] = uploader.discovered_at
+    stage('upload')
+    return (uploader.exit_code, timings)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog -i image -f spyfile [options]")
+    parser.add_option("-i", "--image", dest="image", default=None,
+                      help="The core image to flash (.sfi, .hex, .bin or .blk).")
+    parser.add_option("-f", "--filename", dest="filename", default=None,
+                      help="The SPY file to upload.")
+    parser.add_option("-p", "--port", dest="port", default='/dev/ttyS1',
+                      help="The serial device to use.")
+    parser.add_option("-t", "--serial_type", dest="serial_type", type="int",
+                      default=snap.SERIAL_TYPE_RS232,
+                      help="SNAP Connect serial port type (Default RS-232).")
+    FlashBridge.add_flash_options(parser)
+    parser.add_option("-n", "--no-cache", dest="use_cache", default=True,
+                      action="store_false",
+                      help="Do not record the discovered bridge address for spy_uploader.")
+    parser.add_option("--discovery-timeout", dest="discovery_timeout", type="float",
+                      default=REBOOT_DISCOVERY_TIMEOUT,
+                      help="Seconds to wait for the rebooted bridge to be discovered (Default %default).")
+    (options, _) = parser.parse_args()
+
+    if options.image is None or options.filename is None:
+        parser.error("Both an image (-i) and a SPY file (-f) are required")
+    try:
+        options.port = int(options.port)
+    except ValueError:
+        pass
+    FlashBridge.check_flash_options(options)
+    RF200Flasher.configure_logging(options.log_level, options.log_file)
+
+    cache = spy_uploader.BridgeAddressCache() if options.use_cache else None
+    (exit_code, timings) = provision(options.image, options.filename,
+                                     options.port, options.serial_type,
+                                     options.base, options.resume,
+                                     options.delta, cache, options.trace,
+                                     options.discovery_timeout)
+
+    for (name, seconds) in timings:
+        print "%-8s %6.2fs" % (name, seconds)
+    print "%-8s %6.2fs" % ('total', sum(seconds for (_, seconds) in timings))
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,15 @@ __docformat__ = "plaintext en"
 
 import binascii
 import array
+import bz2
+import os
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+
+BLOCKED_MAGIC = 'BLK1'
 
 
 class ReaderError(Exception):
@@ -49,6 +58,24 @@ class IntelHexData(object):
     int_address = property(get_int_address)
 
 
+def split_blocks(image, length, full_size, addr_adjust):
+    """Split a flat image string into IntelHexData blocks of length bytes,
+    skipping any block that is entirely FFs"""
+    blocks = []
+    for index in range(0, full_size, length):
+        data = image[index:index+length]
+        bin = array.array('B', data)
+        crc = (~sum(bin)+1) % 2**8
+        addr = '%04X' % (index/addr_adjust)
+
+        # Check to make sure that this data set is not all FFs
+        if data != '\xff'*len(data):
+            blocks.append(IntelHexData(addr, data, crc))
+        else:
+            log.debug("dropping all FFs @ %s", addr)
+    return blocks
+
+
 class IntelHexReader(object):
     def __init__(self):
         self._lines = []  # Raw text lines from input file
@@ -68,22 +95,26 @@ class IntelHexReader(object):
             len_int = int(binascii.hexlify(record.length), 16)
             alldata[addr:addr+len_int] = record.data
 
-        for index in range(0, full_size, length):
-            data = ''.join(alldata[index:index+length])
-            bin = array.array('B', data)
-            crc = (~sum(bin)+1) % 2**8
-            addr = '%04X' % (index/addr_adjust)
-
-            # Check to make sure that this data set is not all FFs
-            if data != '\xff'*len(data):
-                self.combined_data.append(IntelHexData(addr, data, crc))
-            elif __debug__:
-                print "dropping all FFs @", addr
+        self.combined_data.extend(split_blocks(''.join(alldata), length,
+                                               full_size, addr_adjust))
 
         # Calc CRC of combined image and return it
         bin = array.array('B', ''.join(alldata))
         return sum(bin) % 2**8
 
+    def to_binary(self):
+        """Flatten the records read by verify() into a single image that
+        starts at address 0, with any gaps filled with FFs"""
+        spans = [(int(binascii.hexlify(r.address), 16), r.data)
+                 for r in self.data]
+        if not spans:
+            return ''
+        end = max(addr+len(data) for (addr, data) in spans)
+        image = bytearray('\xff' * end)
+        for (addr, data) in spans:
+            image[addr:addr+len(data)] = data
+        return str(image)
+
     def get_data_generator(self):
         for obj in self.data:
             yield obj
@@ -167,7 +198,7 @@ class IntelHexReader(object):
             line = line.strip()
             # verify that the length is correct, and
             # that we don't have a problem
-            if line[0] != ':' or len(line) < 11:
+            if line[:1] != ':' or len(line) < 11:
                 # According to file format there is always at least
                 # 11 bytes per line and starts with ":"
                 raise ReaderError("Invalid line found in file")
@@ -223,16 +254,161 @@ class IntelHexReader(object):
                     raise ReaderError("Invalid Start Segment Address Record")
                 if self.start_addr:
                     raise ReaderError("Duplicate start address")
-                rec = array.array('B', binascii.unhexlify(line[9:-2]))
+                try:
+                    rec = array.array('B', binascii.unhexlify(line[9:-2]))
+                except TypeError:
+                    raise ReaderError("Found non-hex characters")
+                if len(rec) != 4:
+                    raise ReaderError("Invalid Start Segment Address Record")
                 self.start_addr = {'CS': rec[0]*256 + rec[1],
                                    'IP': rec[2]*256 + rec[3],
                                   }
             elif line[7:9] == "04":
                 # We have found a change base message
-                if binascii.unhexlify(line[11:-2]) != '\x00':
-                    offset = binascii.unhexlify(line[11:-2])
+                try:
+                    base = binascii.unhexlify(line[11:-2])
+                except TypeError:
+                    raise ReaderError("Found non-hex characters")
+                if base != '\x00':
+                    offset = base
             elif line[7:9] == '05':
                 pass
             else:
                 # We don't currently support any other record types
                 raise ReaderError("Unsupported record type")
+
+
+class BinaryImage(object):
+    """A flat binary flash image starting at base_address.
+    Provides the same combine interface as IntelHexReader without
+    any text parsing"""
+    def __init__(self, data='', base_address=0):
+        self.data = data
+        self.base_address = base_address
+        self.combined_data = []
+
+    def read(self, fp):
+        self.data = fp.read()
+
+    def combine(self, length=512, full_size=4*0x8000-1, addr_adjust=4):
+        image = '\xff'*self.base_address + self.data
+        if len(image) > full_size:
+            raise ReaderError("Image does not fit in device flash")
+        image += '\xff'*(full_size-len(image))
+
+        self.combined_data.extend(split_blocks(image, length, full_size,
+                                               addr_adjust))
+
+        # Calc CRC of combined image and return it
+        return sum(array.array('B', image)) % 2**8
+
+    def get_combined_data_generator(self):
+        for obj in self.combined_data:
+            yield obj
+
+
+class BlockedImage(object):
+    """A flash image that has already been split into fixed length blocks.
+    Blocks are (byte address, data) tuples; all FF blocks are omitted"""
+    def __init__(self, blocks=None, block_len=0):
+        self.blocks = blocks or []
+        self.block_len = block_len
+        self.combined_data = []
+
+    def read(self, fp):
+        raw = fp.read()
+        if raw[:len(BLOCKED_MAGIC)] != BLOCKED_MAGIC:
+            raise ReaderError("Not a blocked image file")
+        offset = len(BLOCKED_MAGIC)
+        if len(raw) < offset+2:
+            raise ReaderError("Truncated blocked image")
+        (self.block_len,) = struct.unpack_from(">H", raw, offset)
+        offset += 2
+        if not self.block_len:
+            raise ReaderError("Invalid block length in blocked image")
+        self.blocks = []
+        while offset < len(raw):
+            if len(raw) < offset+4+self.block_len:
+                raise ReaderError("Truncated blocked image")
+            (addr,) = struct.unpack_from(">I", raw, offset)
+            offset += 4
+            data = raw[offset:offset+self.block_len]
+            offset += self.block_len
+            self.blocks.append((addr, data))
+
+    def write(self, fp):
+        fp.write(BLOCKED_MAGIC + struct.pack(">H", self.block_len))
+        for (addr, data) in self.blocks:
+            fp.write(struct.pack(">I", addr) + data)
+
+    def combine(self, length=512, full_size=4*0x8000-1, addr_adjust=4):
+        if length != self.block_len:
+            raise ReaderError("Image block length does not match device")
+
+        for (addr, data) in self.blocks:
+            if addr % length or addr+length > full_size:
+                raise ReaderError("Block does not fit in device flash")
+            crc = (~sum(array.array('B', data))+1) % 2**8
+            self.combined_data.append(IntelHexData('%04X' % (addr/addr_adjust),
+                                                   data, crc))
+
+        # Everything not covered by a block is FFs
+        total = sum(sum(array.array('B', data)) for (_, data) in self.blocks)
+        total += 0xff * (full_size - len(self.blocks)*length)
+        return total % 2**8
+
+    def get_combined_data_generator(self):
+        for obj in self.combined_data:
+            yield obj
+
+    @classmethod
+    def from_binary(cls, image, block_len):
+        """Build a BlockedImage from a BinaryImage, dropping all FF blocks"""
+        data = '\xff'*image.base_address + image.data
+        if len(data) % block_len:
+            data += '\xff'*(block_len - len(data) % block_len)
+        blocks = []
+        for index in range(0, len(data), block_len):
+            block = data[index:index+block_len]
+            if block != '\xff'*block_len:
+                blocks.append((index, block))
+        return cls(blocks, block_len)
+
+
+def open_hex(filename):
+    """Open an Intel HEX file, transparently decompressing SFI files"""
+    # Assume that the file is an SFI file
+    fp = bz2.BZ2File(filename, 'r')
+    try:
+        # Try to go to the end of the file
+        fp.seek(-1, os.SEEK_END)
+        # And move back to the beginning
+        fp.seek(0, os.SEEK_SET)
+    except IOError:
+        # If we got an IOError, assume we were not an SFI file
+        # and open the file normally
+        fp = open(filename, 'rb')
+    return fp
+
+
+def load_image(filename, base_address=0):
+    """Load a flash image based on its extension.
+    .bin files are raw binaries placed at base_address, .blk files are
+    pre-blocked images and anything else is treated as SFI/Intel HEX"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.bin':
+        image = BinaryImage(base_address=base_address)
+        fp = open(filename, 'rb')
+    elif ext == '.blk':
+        image = BlockedImage()
+        fp = open(filename, 'rb')
+    else:
+        image = IntelHexReader()
+        fp = open_hex(filename)
+    try:
+        image.read(fp)
+    finally:
+        fp.close()
+    if isinstance(image, IntelHexReader):
+        image.verify(round=1)
+    return image
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Copyright 2009-2014, Synapse Wireless Inc., All rights Reserved.
+#
+# Neither the name of Synapse nor the names of contributors may be used to
+# endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# This software is provided "AS IS," without a warranty of any kind. ALL
+# EXPRESS OR IMPLIED CONDITIONS, REPRESENTATIONS AND WARRANTIES, INCLUDING ANY
+# IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, ARE HEREBY EXCLUDED. SYNAPSE AND ITS LICENSORS SHALL NOT BE
+# LIABLE FOR ANY DAMAGES SUFFERED BY LICENSEE AS A RESULT OF USING, MODIFYING
+# OR DISTRIBUTING THIS SOFTWARE OR ITS DERIVATIVES. IN NO EVENT WILL SYNAPSE OR
+# ITS LICENSORS BE LIABLE FOR ANY LOST REVENUE, PROFIT OR DATA, OR FOR DIRECT,
+# INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE DAMAGES, HOWEVER
+# CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, ARISING OUT OF THE USE OF
+# OR INABILITY TO USE THIS SOFTWARE, EVEN IF SYNAPSE HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+"""Benchmarks the SPY upload path against FakeSnap so upload time, bridge
+discovery latency and CPU usage can be tracked across releases without
+hardware. Results can be saved and compared against a previous run.
+
+On a loss-free link every reply's ideal arrival time is known, so the
+'overhead' metric is how long, on average, each reply waited for the poll
+loop to pick it up. Any scenario exceeding MAX_POLL_OVERHEAD fails"""
+
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import optparse
+from cStringIO import StringIO
+
+import fake_snap
+import spy_uploader
+
+
+# name: LinkModel arguments
+SCENARIOS = (('clean', {'chunk_latency': 0.02}),
+             ('lossy', {'chunk_latency': 0.02, 'loss': 0.05}),
+             ('slow', {'chunk_latency': 0.1}),
+             ('cached', {'chunk_latency': 0.02}),)
+
+METRICS = ('total', 'upload', 'discovery', 'cpu', 'overhead')
+
+MAX_POLL_OVERHEAD = 0.005  # seconds per reply
+
+# os.times() only advances in whole clock ticks, so a CPU difference of a
+# couple of ticks is measurement noise rather than a regression
+CPU_TOLERANCE = 2.0 / os.sysconf('SC_CLK_TCK')  # seconds
+
+
+def run_once(spy, link, cache=None):
+    """Upload spy over a FakeSnap link and return the measured metrics"""
+    uploader = spy_uploader.SpyUploader('<benchmark>', serial_port='bench',
+                                        cache=cache, defer_open=True,
+                                        comm_factory=lambda funcs: fake_snap.FakeSnap(funcs, link))
+    uploader.spy = spy
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        uploader.open()
+        uploader.run()
+    finally:
+        sys.stdout = stdout
+
+    (upload, cpu) = uploader.metrics.elapsed()
+    result = {'ok': uploader.exit_code == 0,
+              'total': uploader.metrics.wall_end - uploader.opened_at,
+              'upload': upload,
+              'cpu': cpu,
+              'discovery': None}
+    if uploader.discovered_at is not None:
+        result['discovery'] = uploader.discovered_at - uploader.opened_at
+    result['overhead'] = None
+    if link.loss == 0:
+        chunks = (len(spy) + link.chunk_size - 1) / link.chunk_size
+        ideal = chunks * link.chunk_latency + link.reboot_latency
+        # One tellVmStat per chunk plus the reboot notice
+        result['overhead'] = (upload - ideal) / (chunks + 1)
+    return result
+
+
+def _median(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    mid = len(values) / 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid-1] + values[mid]) / 2.0
+
+
+def run_scenario(name, link_args, spy, iterations, seed=0):
+    cache = None
+    cache_dir = None
+    if name == 'cached':
+        cache_dir = tempfile.mkdtemp()
+        cache = spy_uploader.BridgeAddressCache(os.path.join(cache_dir, 'cache.json'))
+        cache.remember('%s:%s' % (spy_uploader.snap.SERIAL_TYPE_RS232, 'bench'),
+                       fake_snap.DEFAULT_BRIDGE_ADDR)
+    try:
+        runs = [run_once(spy, fake_snap.LinkModel(seed=seed+i, **link_args), cache)
+                for i in range(iterations)]
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, True)
+
+    summary = dict((metric, _median([run[metric] for run in runs]))
+                   for metric in METRICS)
+    summary['failures'] = len([run for run in runs if not run['ok']])
+    return summary
+
+
+def compare(results, baseline, threshold):
+    """Return a list of (scenario, metric, old, new) regressions. A metric
+    regresses when it grows by more than threshold (a fraction) and, for
+    CPU time, by more than CPU_TOLERANCE as well"""
+    regressions = []
+    for (name, summary) in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for metric in ('total', 'upload', 'cpu'):
+            if old.get(metric) is None or summary.get(metric) is None:
+                continue
+            limit = old[metric] * (1 + threshold)
+            if metric == 'cpu':
+                limit = max(limit, old[metric] + CPU_TOLERANCE)
+            if summary[metric] > limit:
+                regressions.append((name, metric, old[metric], summary[metric]))
+    return regressions
+
+
+def _fmt(value):
+    if value is None:
+        return '     -'
+    return '%6.3f' % value
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-f", "--filename", dest="filename", default=None,
+                      help="SPY file to upload (Default synthetic data).")
+    parser.add_option("-s", "--size", dest="size", type="int", default=4096,
+                      help="Size of the synthetic SPY image in bytes (Default 4096).")
+    parser.add_option("-n", "--iterations", dest="iterations", type="int", default=3,
+                      help="Runs per scenario (Default 3).")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Save the results as JSON for later comparison.")
+    parser.add_option("-c", "--compare", dest="baseline", default=None,
+                      help="Compare against results saved by a previous run.")
+    parser.add_option("--threshold", dest="threshold", type="float", default=0.1,
+                      help="Allowed slowdown before a regression is reported (Default 0.1).")
+    (options, _) = parser.parse_args()
+
+    if options.filename is not None:
+        try:
+            spy = spy_uploader.read_spy(options.filename)
+        except IOError:
+            print "Unable to read SPY file"
+            sys.exit(1)
+    else:
+        spy = os.urandom(options.size)
+
+    print "%-8s %s failures" % ('scenario', ' '.join('%9s' % m for m in METRICS))
+    results = {}
+    slow_polls = []
+    for (name, link_args) in SCENARIOS:
+        summary = run_scenario(name, link_args, spy, options.iterations)
+        results[name] = summary
+        print "%-8s %s %d" % (name, ' '.join('   ' + _fmt(summary[m]) for m in METRICS),
+                              summary['failures'])
+        if summary['overhead'] is not None and summary['overhead'] > MAX_POLL_OVERHEAD:
+            slow_polls.append(name)
+
+    if options.output is not None:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    for name in slow_polls:
+        print "SLOW POLL %s: %.3fs per reply over the link latency (limit %.3fs)" % (
+            name, results[name]['overhead'], MAX_POLL_OVERHEAD)
+
+    if options.baseline is not None:
+        f = open(options.baseline, 'r')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline, options.threshold)
+        for (name, metric, old, new) in regressions:
+            print "REGRESSION %s %s: %.3fs -> %.3fs" % (name, metric, old, new)
+        if regressions:
+            sys.exit(1)
+    if slow_polls:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ import os
 import time
 import datetime
 import binascii
+import json
 
 from snapconnect import snap
 
@@ -30,58 +31,268 @@ from snaplib import ScriptsManager, SnappyUploader, RpcCodec
 
 
 BRIDGE_TIMEOUT = 2.5  # seconds
+POLL_MIN_IDLE = 0.001  # seconds
+POLL_MAX_IDLE = 0.05  # seconds
+BRIDGE_CACHE_PATH = os.path.expanduser('~/.gateway_utils/bridge_addresses.json')
+
+
+class BridgeAddressCache:
+    """Persists the SNAP address of the bridge found on each serial port"""
+    def __init__(self, path=BRIDGE_CACHE_PATH):
+        self.path = path
+
+    def _load(self):
+        try:
+            f = open(self.path, 'r')
+            try:
+                entries = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _save(self, entries):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            f = open(self.path, 'w')
+            try:
+                json.dump(entries, f, sort_keys=True)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            pass
+
+    def get(self, port):
+        addr = self._load().get(port)
+        if addr is None:
+            return None
+        try:
+            return binascii.unhexlify(addr)
+        except TypeError:
+            return None
+
+    def remember(self, port, remote_addr):
+        entries = self._load()
+        entries[port] = binascii.hexlify(remote_addr)
+        self._save(entries)
+
+    def forget(self, port):
+        entries = self._load()
+        if entries.pop(port, None) is not None:
+            self._save(entries)
+
+
+def read_spy(filename):
+    """Read a SPY export and return the SNAPpy image it contains"""
+    f = open(filename, 'rb')
+    try:
+        return ScriptsManager.getSnappyStringFromExport(f.read())
+    finally:
+        f.close()
+
+
+class UploadMetrics:
+    """Wall clock and CPU time spent on a single upload"""
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.wall_start = time.time()
+        self.cpu_start = self._cpu_time()
+        self.wall_end = None
+        self.cpu_end = None
+        self.polls = 0
+        self.sleeps = 0
+
+    def stop(self):
+        self.wall_end = time.time()
+        self.cpu_end = self._cpu_time()
+
+    def _cpu_time(self):
+        (user, system) = os.times()[:2]
+        return user + system
+
+    def elapsed(self):
+        """Returns (wall seconds, CPU seconds) from start() to stop(), or
+        to now if the upload is still running"""
+        if self.wall_end is None:
+            return (time.time() - self.wall_start, self._cpu_time() - self.cpu_start)
+        return (self.wall_end - self.wall_start, self.cpu_end - self.cpu_start)
+
+    def report(self):
+        (wall, cpu) = self.elapsed()
+        return "%.2fs wall, %.2fs CPU (%.0f%%), %d polls, %d sleeps" % (
+            wall, cpu, 100.0 * cpu / wall if wall else 0.0, self.polls, self.sleeps)
 
 
 class SpyUploader:
-    def __init__(self, filename, serial_type=snap.SERIAL_TYPE_RS232, serial_port=0):
+    def __init__(self, filename, serial_type=snap.SERIAL_TYPE_RS232, serial_port=0, cache=None, defer_open=False, comm_factory=None,
+                 discovery_timeout=BRIDGE_TIMEOUT):
         self.filename = filename
+        self.spy = None
         self.running = True
+        self.exit_code = None
         self.remote_addr = None
+        self.cache = cache
+        self.discovery_timeout = discovery_timeout
+        self.serial_type = serial_type
+        self._cache_key = "%s:%s" % (serial_type, serial_port)
+        self._discovered = False
+        self._upload = None
+        self.metrics = UploadMetrics()
+        self._activity = False
+        self.opened_at = None
+        self.discovered_at = None
         try:
-            _port = int(serial_port)
+            self.serial_port = int(serial_port)
         except ValueError:
-            _port = serial_port
+            self.serial_port = serial_port
 
         # Create a SNAP Connect object to do communications (comm) for us
-        self.comm = snap.Snap(funcs={'tellVmStat': lambda *args: self.comm.spy_upload_mgr.onTellVmStat(self.comm.rpc_source_addr(), *args),
-                                     'su_recvd_reboot': lambda *args: self.comm.spy_upload_mgr.on_recvd_reboot(self.comm.rpc_source_addr())})
+        if comm_factory is None:
+            comm_factory = snap.Snap
+        self.comm = comm_factory(funcs={'tellVmStat': self._on_tell_vm_stat,
+                                     'su_recvd_reboot': self._on_recvd_reboot})
         self.comm.save_nv_param(snap.NV_FEATURE_BITS_ID, 0x0100)  # RPC CRC
         RpcCodec.validateCrc = False
-        self.comm.register_callback('next_hop_addr', lambda remote_addr, intf: self.start_upload(remote_addr))
+        self.comm.register_callback('next_hop_addr', self._on_next_hop_addr)
+
+        if not defer_open:
+            self.open()
+
+    def open(self, use_cache=True):
+        """Open the serial port and start looking for the bridge. Pass
+        use_cache=False to wait for discovery even if the address is cached,
+        e.g. while the bridge is still rebooting"""
+        self.comm.open_serial(self.serial_type, self.serial_port)
+        self.opened_at = time.time()
+
+        if use_cache and self.cache is not None:
+            cached_addr = self.cache.get(self._cache_key)
+            if cached_addr is not None:
+                # Start right away; discovery still runs to confirm the address
+                self.start_upload(cached_addr)
+
+        self.comm.scheduler.schedule(self.discovery_timeout, self._bridge_timeout)
+
+    def load_spy(self):
+        """Read and parse the SPY file, returning False if it is unreadable"""
+        try:
+            self.spy = read_spy(self.filename)
+        except IOError:
+            return False
+        return True
+
+    def _on_tell_vm_stat(self, *args):
+        self._activity = True
+        if self.comm.rpc_source_addr() != self.remote_addr:
+            # Replies from a node we are no longer uploading to
+            return
+        self.comm.spy_upload_mgr.onTellVmStat(self.comm.rpc_source_addr(), *args)
+
+    def _on_recvd_reboot(self, *args):
+        self._activity = True
+        if self.comm.rpc_source_addr() != self.remote_addr:
+            return
+        self.comm.spy_upload_mgr.on_recvd_reboot(self.comm.rpc_source_addr())
+
+    def run(self):
+        """Drive SNAP Connect until the upload finishes. Instead of spinning,
+        sleep until the next scheduled event. Replies arrive on the serial
+        port rather than the scheduler, so while an upload is in flight the
+        sleep stays at POLL_MIN_IDLE; only while waiting on the bridge with
+        nothing outstanding does it back off towards POLL_MAX_IDLE"""
+        idle = POLL_MIN_IDLE
+        while self.running:
+            self.comm.poll_internals()
+            next_event = self.comm.scheduler.poll()
+            self.metrics.polls += 1
+
+            if self._activity or self._upload is not None:
+                self._activity = False
+                idle = POLL_MIN_IDLE
+            else:
+                idle = min(idle * 2, POLL_MAX_IDLE)
 
-        self.comm.open_serial(serial_type, _port)
-        self.comm.scheduler.schedule(BRIDGE_TIMEOUT, self._bridge_timeout)
+            delay = idle
+            if next_event is not None:
+                delay = max(0, min(delay, next_event))
+            if delay:
+                self.metrics.sleeps += 1
+                time.sleep(delay)
+
+    def _on_next_hop_addr(self, remote_addr, intf):
+        self._activity = True
+        if self._discovered:
+            return
+        self._discovered = True
+        self.discovered_at = time.time()
+
+        if self.cache is not None:
+            self.cache.remember(self._cache_key, remote_addr)
+        if remote_addr == self.remote_addr:
+            # Cached address confirmed, the upload is already under way
+            return
+        if self.remote_addr is not None:
+            print "Cached bridge address was wrong, restarting upload"
+            self._abort_upload()
+        self.start_upload(remote_addr)
+
+    def _abort_upload(self):
+        """Tear down the upload to a stale cached address. The upload manager
+        has no way to cancel it, but once remote_addr moves on its RPC
+        replies are dropped and its finished callback is ignored, so it
+        cannot progress past the step it is on"""
+        self._upload = None
 
     def _bridge_timeout(self):
         if self.remote_addr is None:
             print "Unable to determine SNAP bridge node address"
-            sys.exit(1)
+            self._finish(1)
+
+    def _finish(self, exit_code):
+        self.exit_code = exit_code
+        self.running = False
 
     def start_upload(self, remote_addr):
         """Called internally for every upload attempt. You should be calling beginUpload()"""
+        self._activity = True
         self.remote_addr = remote_addr
-        try:
-            f = open(self.filename, 'rb')
-            try:
-                spy = ScriptsManager.getSnappyStringFromExport(f.read())
-            finally:
-                f.close()
-        except IOError:
+        if self.spy is None and not self.load_spy():
             print "Unable to read SPY file"
-            sys.exit(1)
+            self._finish(1)
+            return
 
-        upload = self.comm.spy_upload_mgr.startUpload(remote_addr, spy)
-        upload.registerFinishedCallback(self._upload_finished)
+        self.metrics.start()
+        self._upload = self.comm.spy_upload_mgr.startUpload(remote_addr, self.spy)
+        self._upload.registerFinishedCallback(self._upload_finished)
         self.running = True
 
     def _upload_finished(self, snappy_upload_obj, result):
+        if snappy_upload_obj is not self._upload:
+            # An upload to a stale cached address was superseded
+            return
+        self.metrics.stop()
+        print "Upload took %s" % self.metrics.report()
         if result == SnappyUploader.SNAPPY_PROGRESS_COMPLETE:
             print "Successfully uploaded the SPY file"
-            sys.exit(0)
+            self._finish(0)
         else:
+            if self.cache is not None:
+                self.cache.forget(self._cache_key)
+            if not self._discovered:
+                # Only the cached address was tried; let discovery restart
+                # the upload, or _bridge_timeout give up
+                print "Upload to the cached bridge address failed, waiting for discovery"
+                self._upload = None
+                self.remote_addr = None
+                return
             print "SPY file was NOT uploaded successfully"
-            sys.exit(result)
-        self.running = False
+            self._finish(result)
 
 
 def main():
@@ -91,6 +302,7 @@ def main():
     parser.add_option("-t", "--serial_type", default=1, dest="serial_type", help="Specifies the serial port type to open (Default RS-232")
     parser.add_option("-p", "--serial_port", default=0, dest="serial_port", help="Specifies the serial port name or number to open (Default 0)")
     parser.add_option("-f", "--filename", dest="filename", help="The SPY file to upload")
+    parser.add_option("-n", "--no-cache", default=True, action="store_false", dest="use_cache", help="Always discover the bridge address instead of using the cached one")
     (options, args) = parser.parse_args()
 
     if options.filename is None:
@@ -100,9 +312,10 @@ def main():
         print "The SPY file specified does not exist"
         sys.exit(1)
 
-    uploader = SpyUploader(options.filename, options.serial_type, options.serial_port)
-    while uploader.running:
-        uploader.comm.loop()
+    cache = BridgeAddressCache() if options.use_cache else None
+    uploader = SpyUploader(options.filename, options.serial_type, options.serial_port, cache)
+    uploader.run()
+    sys.exit(uploader.exit_code)
 
 
 if __name__ == "__main__":
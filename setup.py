@@ -26,6 +26,10 @@ setup(name='gateway-utils',
       packages=['gateway_utils'],
       install_requires=required,
       entry_points={'console_scripts': ['spy_uploader = gateway_utils.spy_uploader:main',
-                                        'flash_bridge = gateway_utils.FlashBridge:main']},
+                                        'flash_bridge = gateway_utils.FlashBridge:main',
+                                        'hex2bin = gateway_utils.hex2bin:main',
+                                        'index_images = gateway_utils.image_index:main',
+                                        'provision = gateway_utils.provision:main',
+                                        'spy_bench = gateway_utils.spy_bench:main']},
       options={'egg_info': {'tag_build': "dev_" + GIT_HEAD_REV}},
       )